@@ -18,21 +18,64 @@
 #  Last modified: 2022.01.17 at 14:36:59 CET
 import ctypes
 import hashlib
+import io
 import json
 import os
-import shutil
+import signal
 import subprocess
+import sys
 import tempfile
 import time
 import traceback
+import zipfile
+from functools import lru_cache
 from pathlib import Path
-from subprocess import CompletedProcess
-from threading import Thread
-from typing import Dict, Optional
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Optional, Tuple
+
+try:
+	from importlib import metadata
+except ImportError: # Python 3.7
+	import importlib_metadata as metadata
+
+try:
+	# Optional, parses bytes without an intermediate str copy, but has no wheels for every platform
+	from orjson import loads as jsonLoads
+except ImportError:
+	from json import loads as jsonLoads
 
 import click
 import paho.mqtt.client as mqtt
-import pkg_resources
+from snips_nlu import __version__ as snipsVersion
+from snips_nlu.constants import DATA_PATH
+from snips_nlu.resources import load_resources
+
+from AliceNluTrainer.training import fitEngine
+
+
+class HashingWriter(object):
+	"""
+	Write only file object feeding a blake2b hash with everything written to the underlying stream.
+	It exposes neither tell nor seek, so zipfile streams entries with data descriptors instead of
+	seeking back to patch headers, which keeps the hash in line with the final bytes
+	"""
+
+	def __init__(self, stream: io.BufferedIOBase):
+		self._stream = stream
+		self._hash = hashlib.blake2b()
+
+
+	def write(self, data: bytes) -> int:
+		self._hash.update(data)
+		return self._stream.write(data)
+
+
+	def flush(self):
+		self._stream.flush()
+
+
+	def hexdigest(self) -> str:
+		return self._hash.hexdigest()
 
 
 class NLUTrainer(object):
@@ -48,9 +91,13 @@ class NLUTrainer(object):
 	TOPIC_CORE_RECONNECTION = 'projectalice/devices/coreReconnection'
 	TOPIC_TRAINING_STATUS   = 'projectalice/nlu/trainingStatus'
 
-	DATASET_FILE = Path(tempfile.NamedTemporaryFile().name)
 	DEBUG_DATA_FILE = Path('debugDataset.json')
 
+	CACHE_DIR = Path.home() / '.cache' / 'projectalice-nlu-trainer'
+	CACHE_SIZE = 5
+
+	PUBLISH_TIMEOUT = 120
+
 	def __init__(self, hostname: str = 'localhost', port: int = 1883, user: str = '', password: str = '', tlsFile: str = ''):
 		self._hostname = hostname
 		self._port = port
@@ -58,26 +105,24 @@ class NLUTrainer(object):
 		self._password = password
 		self._tlsFile = tlsFile
 
-		if not self.isAdmin():
-			print('Please run this script with admin rights, as we need to write on the disk.')
-			exit(1)
+		if os.name == 'nt' and ctypes.windll.shell32.IsUserAnAdmin() == 0:
+			print('Not running with admin rights. On Windows, installing language packs creates symlinks, which needs admin rights or Developer Mode to be enabled')
 
 		self._mqttClient = mqtt.Client()
 		self._training = False
 		self._trainingThread: Optional[Thread] = None
+		self._trainingLock = Lock()
+		self._pendingTraining: Optional[Tuple[str, Dict]] = None
+		self._topicHandlers: Dict[str, Callable[[mqtt.MQTTMessage], None]] = {
+			self.TOPIC_CORE_RECONNECTION: self.onCoreReconnection,
+			self.TOPIC_TRAINING_STATUS  : self.onTrainingStatus,
+			self.TOPIC_TRAIN            : self.onTrainingTask
+		}
 		self._mqttClient.on_message = self.onMqttMessage
 		self._mqttClient.on_log = self.onLog
 		self._mqttClient.on_connect = self.onConnect
 
 
-	@staticmethod
-	def isAdmin() -> bool:
-		try:
-			return os.getuid() == 0
-		except AttributeError:
-			return ctypes.windll.shell32.IsUserAnAdmin() != 0
-
-
 	def connect(self):
 		try:
 			print(f'Connecting to {self._hostname}:{self._port}')
@@ -103,37 +148,50 @@ class NLUTrainer(object):
 
 
 	def onMqttMessage(self, _client, _userdata, message: mqtt.MQTTMessage):
-		if message.topic == self.TOPIC_CORE_RECONNECTION:
-			self._mqttClient.publish(topic=self.TOPIC_READY)
-			print('Alice main unit just connected')
-		elif message == self.TOPIC_TRAINING_STATUS:
-			self._mqttClient.publish(self.TOPIC_TRAINING_STATUS, payload=json.dumps({'status': 'training' if self._training else 'done'}))
-		elif message.topic == self.TOPIC_TRAIN:
-			try:
-				print('Received training task')
+		handler = self._topicHandlers.get(message.topic)
+		if handler:
+			handler(message)
 
-				if not message.payload:
-					raise Exception('No payload in message')
 
-				payload = json.loads(message.payload.decode())
-				data = payload.get('data', dict())
-				language = payload.get('language', None)
+	def onCoreReconnection(self, _message: mqtt.MQTTMessage):
+		self._mqttClient.publish(topic=self.TOPIC_READY)
+		print('Alice main unit just connected')
+
 
-				if not data:
-					if self.DEBUG_DATA_FILE.exists():
-						print('Using debug data')
-						data = json.loads(self.DEBUG_DATA_FILE.read_text())
-					else:
-						raise Exception('No training data received')
+	def onTrainingStatus(self, message: mqtt.MQTTMessage):
+		# Status answers are published on the same topic, ours included. Only answer empty requests, or we would answer ourselves forever
+		if message.payload:
+			return
 
-				if not language:
-					raise Exception('Language not specified')
+		self._mqttClient.publish(self.TOPIC_TRAINING_STATUS, payload=json.dumps({'status': 'training' if self._training else 'done'}))
 
-				self.train(language=language, trainingData=data)
 
-			except Exception as e:
-				print(f'Failed training NLU: {e}')
-				self.failedTraining(reason=str(e))
+	def onTrainingTask(self, message: mqtt.MQTTMessage):
+		try:
+			print('Received training task')
+
+			if not message.payload:
+				raise Exception('No payload in message')
+
+			payload = jsonLoads(message.payload)
+			data = payload.get('data', dict())
+			language = payload.get('language', None)
+
+			if not data:
+				if self.DEBUG_DATA_FILE.exists():
+					print('Using debug data')
+					data = jsonLoads(self.DEBUG_DATA_FILE.read_bytes())
+				else:
+					raise Exception('No training data received')
+
+			if not language:
+				raise Exception('Language not specified')
+
+			self.train(language=language, trainingData=data)
+
+		except Exception as e:
+			print(f'Failed training NLU: {e}')
+			self.failedTraining(reason=str(e))
 
 
 	def failedTraining(self, reason: str):
@@ -147,70 +205,179 @@ class NLUTrainer(object):
 	def train(self, language: str, trainingData: Dict):
 		print('Preparing dataset')
 
-		if self._training:
-			reason = "Already training, can't train now"
+		try:
+			dataset = {
+				'entities': trainingData['entities'],
+				'intents' : trainingData['intents'],
+				'language': language
+			}
+			print('Generated dataset for training')
+		except Exception as e:
+			reason = f'Something went wrong preparing NLU training: {e}'
 			print(reason)
 			self.failedTraining(reason=reason)
 			return
 
-		try:
+		with self._trainingLock:
+			if self._training:
+				# Only the most recent task is worth training, it replaces any task already waiting
+				print('Already training, this task will be trained next unless a newer one comes in meanwhile')
+				self._pendingTraining = (language, dataset)
+				return
+
 			self._training = True
-			dataset = {
-				'entities': dict(),
-				'intents' : dict(),
-				'language': language
-			}
 
-			dataset['entities'].update(trainingData['entities'])
-			dataset['intents'].update(trainingData['intents'])
+		self.startTrainingThread(language=language, dataset=dataset)
 
-			self.DATASET_FILE.write_text(data=json.dumps(dataset, ensure_ascii=False, indent='\t'))
-			print('Generated dataset for training')
-			self._trainingThread = Thread(name='NLUTraining', target=self.trainingThread, daemon=True, kwargs={'language': language})
+
+	def startTrainingThread(self, language: str, dataset: Dict):
+		try:
+			self._trainingThread = Thread(name='NLUTraining', target=self.trainingThread, daemon=True, kwargs={'language': language, 'dataset': dataset})
 			self._trainingThread.start()
 		except Exception as e:
-			reason = f'Something went wrong preparing NLU training: {e}'
-			self._training = False
+			with self._trainingLock:
+				self._training = False
+				self._pendingTraining = None
+
+			reason = f'Something went wrong starting NLU training: {e}'
 			print(reason)
 			self.failedTraining(reason=reason)
 
 
-	def trainingThread(self, language: str):
+	def trainingThread(self, language: str, dataset: Dict):
 		try:
 			startTime = time.time()
 
 			self._mqttClient.publish(topic=self.TOPIC_TRAINING)
 
-			print(f'Download language support for {language}')
-			download: CompletedProcess = subprocess.run(f'snips-nlu download {language}', shell=True, check=True)
-			if download.returncode != 0 :
-				raise Exception(download.stderr.decode())
+			datasetHash = self.datasetHash(dataset)
+			cachedNLU = self.CACHE_DIR / f'{datasetHash}.zip'
+
+			if cachedNLU.exists():
+				print('This dataset was already trained, using cached result')
+				data = cachedNLU.read_bytes()
+				fileHash = hashlib.blake2b(data).hexdigest()
+				cachedNLU.touch()
+			else:
+				if not self.isLanguageInstalled(language):
+					print(f'Download language support for {language}')
+					subprocess.run([sys.executable, '-m', 'snips_nlu', 'download', language], check=True)
+
+				print('Begin training')
+
+				engine = fitEngine(dataset=dataset, resources=self.getLanguageResources(language))
 
-			print('Begin training')
+				with tempfile.TemporaryDirectory() as tempDir:
+					trainedNLU = Path(tempDir, 'trainedNLU')
+					engine.persist(trainedNLU)
+					data, fileHash = self.zipDirectory(trainedNLU)
 
-			trainedNLU = Path(tempfile.TemporaryDirectory().name)
-			training: CompletedProcess = subprocess.run(f'snips-nlu train {str(self.DATASET_FILE)} {str(trainedNLU)}', shell=True, check=True)
-			if training.returncode != 0 or not trainedNLU.exists():
-				raise Exception(training.stderr.decode())
+				self.cacheTrainedNLU(datasetHash=datasetHash, data=data)
 
-			archive = Path(tempfile.TemporaryDirectory().name, 'archive')
-			data = Path(shutil.make_archive(str(archive), 'zip', str(trainedNLU))).read_bytes()
 			timer = round(time.time() - startTime, ndigits=2)
-			topic = self.TOPIC_TRAINING_RESULT.format(hashlib.blake2b(archive.with_suffix('.zip').read_bytes()).hexdigest())
+			topic = self.TOPIC_TRAINING_RESULT.format(fileHash)
 
 			print(f'Sending results')
-			self._mqttClient.publish(
+			info = self._mqttClient.publish(
 				topic=topic,
 				payload=data,
-				qos=0
+				qos=1
 			)
+			info.wait_for_publish(timeout=self.PUBLISH_TIMEOUT)
+			if not info.is_published():
+				raise Exception(f'Results could not be sent within {self.PUBLISH_TIMEOUT} seconds')
+
 			print(f'Training done! It took {timer} seconds to train.')
 		except Exception as e:
 			reason = f'Training failed: {e}'
 			print(reason)
 			self.failedTraining(reason=reason)
 		finally:
-			self._training = False
+			with self._trainingLock:
+				pending = self._pendingTraining
+				self._pendingTraining = None
+				self._training = pending is not None
+
+			if pending:
+				print('Starting the training task received meanwhile')
+				self.startTrainingThread(*pending)
+
+
+	@staticmethod
+	def datasetHash(dataset: Dict) -> str:
+		"""
+		Hashes the dataset content, independently of its keys order. The snips version is part of the hash,
+		as the trained NLU embeds it and a result cached by another snips version must not be reused
+		:param dataset: The snips dataset
+		:return: The dataset blake2b hex digest
+		"""
+		canonical = json.dumps(dataset, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+		datasetHash = hashlib.blake2b(digest_size=16)
+		datasetHash.update(f'snips-nlu {snipsVersion}\n'.encode())
+		datasetHash.update(canonical)
+		return datasetHash.hexdigest()
+
+
+	def cacheTrainedNLU(self, datasetHash: str, data: bytes):
+		"""
+		Stores the zipped trained NLU for the given dataset hash, keeping only the most recently used archives
+		:param datasetHash: The hash of the dataset the NLU was trained on
+		:param data: The zipped trained NLU
+		"""
+		try:
+			self.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+			# Left over by a trainer that stopped while writing to the cache
+			for orphan in self.CACHE_DIR.glob('*.part'):
+				orphan.unlink()
+
+			partial = self.CACHE_DIR / f'{datasetHash}.part'
+			partial.write_bytes(data)
+			partial.replace(self.CACHE_DIR / f'{datasetHash}.zip')
+
+			cached = sorted(self.CACHE_DIR.glob('*.zip'), key=lambda file: file.stat().st_mtime, reverse=True)
+			for file in cached[self.CACHE_SIZE:]:
+				file.unlink()
+		except OSError as e:
+			print(f'Could not cache trained NLU: {e}')
+
+
+	@staticmethod
+	def isLanguageInstalled(language: str) -> bool:
+		"""
+		'snips-nlu download' links the installed resources package in the snips data directory, under the language name
+		:param language: The language to check
+		:return: True if the language resources are already installed
+		"""
+		return Path(DATA_PATH, language).exists()
+
+
+	@staticmethod
+	@lru_cache(maxsize=4)
+	def getLanguageResources(language: str) -> dict:
+		"""
+		Loads the snips resources for the given language, keeping those of the 4 most recently trained languages.
+		Engines are not reused, as refitting one keeps slot fillers of intents that were since removed
+		:param language: The language to load the resources for
+		:return: The resources, to be shared by the engines trained on that language
+		"""
+		return load_resources(language)
+
+
+	@staticmethod
+	def zipDirectory(directory: Path) -> Tuple[bytes, str]:
+		"""
+		Zips the given directory in memory, hashing the archive as it is written
+		:param directory: The directory to archive
+		:return: The archive bytes and their blake2b hex digest
+		"""
+		buffer = io.BytesIO()
+		writer = HashingWriter(buffer)
+		with zipfile.ZipFile(writer, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+			for path in sorted(directory.rglob('*')):
+				archive.write(str(path), arcname=path.relative_to(directory).as_posix())
+
+		return buffer.getvalue(), writer.hexdigest()
 
 
 	def onConnect(self, _client, _userdata, _flags, _rc):
@@ -234,14 +401,20 @@ class NLUTrainer(object):
 @click.option('-s', '--password', default='', help='Mqtt server password if required')
 @click.option('-t', '--tls_file', default='', help='Path to TLS certificate file, if required')
 def start(host: str, port: int = 1883, user: str = '', password: str = '', tls_file: str = ''): #NOSONAR
-	version = pkg_resources.require('projectalice-nlu-trainer')[0].version
+	version = metadata.version('projectalice-nlu-trainer')
 	print(f'Starting Project Alice offshore NLU trainer v. {version}')
 
+	stopEvent = Event()
+	signal.signal(signal.SIGINT, lambda *_: stopEvent.set())
+	signal.signal(signal.SIGTERM, lambda *_: stopEvent.set())
+
 	trainer = NLUTrainer(hostname=host, port=port, user=user, password=password, tlsFile=tls_file)
 	try:
 		trainer.connect()
-		while True:
-			time.sleep(0.1)
+		# Windows can't interrupt a blocking wait, so wake up from time to time there to let the signal handler run
+		while not stopEvent.wait(timeout=1 if os.name == 'nt' else None):
+			pass
+		print('Stopping')
 	except KeyboardInterrupt:
 		print('Stopping')
 	except Exception as e:
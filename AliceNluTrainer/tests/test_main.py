@@ -0,0 +1,181 @@
+#  Copyright (c) 2022
+#
+#  This file, test_main.py, is part of Project Alice.
+#
+#  Project Alice is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>
+#
+#  Last modified: 2022.01.17 at 14:36:59 CET
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+import paho.mqtt.client as mqtt
+
+from AliceNluTrainer.main import NLUTrainer
+
+
+TRAINING_DATA = {'entities': dict(), 'intents': dict()}
+
+
+def persistEngine(path: Path):
+	path.mkdir()
+	(path / 'nlu_engine.json').write_text('{}')
+
+
+class TestNLUTrainer(TestCase):
+
+	def setUp(self):
+		patcher = mock.patch('AliceNluTrainer.main.mqtt.Client')
+		self.mqttClient = patcher.start().return_value
+		self.addCleanup(patcher.stop)
+
+		cacheDir = tempfile.TemporaryDirectory()
+		self.addCleanup(cacheDir.cleanup)
+		self.cacheDir = Path(cacheDir.name)
+		patcher = mock.patch.object(NLUTrainer, 'CACHE_DIR', self.cacheDir)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+		self.trainer = NLUTrainer()
+
+
+	@staticmethod
+	def message(topic: str, payload: bytes = b'') -> mqtt.MQTTMessage:
+		message = mqtt.MQTTMessage(topic=topic.encode())
+		message.payload = payload
+		return message
+
+
+	def test_trainWhileTrainingKeepsOnlyLatestTask(self):
+		with mock.patch.object(self.trainer, 'startTrainingThread') as startTrainingThread:
+			self.trainer.train(language='en', trainingData=TRAINING_DATA)
+			startTrainingThread.assert_called_once()
+			self.assertTrue(self.trainer._training)
+
+			self.trainer.train(language='de', trainingData=TRAINING_DATA)
+			self.assertEqual('de', self.trainer._pendingTraining[0])
+
+			self.trainer.train(language='fr', trainingData=TRAINING_DATA)
+			self.assertEqual('fr', self.trainer._pendingTraining[0])
+
+			startTrainingThread.assert_called_once()
+
+
+	def test_failingThreadStartResetsTrainingState(self):
+		with mock.patch('AliceNluTrainer.main.Thread') as thread:
+			thread.return_value.start.side_effect = RuntimeError("can't start new thread")
+			self.trainer._pendingTraining = ('de', TRAINING_DATA)
+			self.trainer.train(language='en', trainingData=TRAINING_DATA)
+
+		self.assertFalse(self.trainer._training)
+		self.assertIsNone(self.trainer._pendingTraining)
+		self.mqttClient.publish.assert_called_once_with(topic=NLUTrainer.TOPIC_REFUSE_FAILED, payload=mock.ANY)
+
+
+	@mock.patch.object(NLUTrainer, 'getLanguageResources')
+	@mock.patch.object(NLUTrainer, 'isLanguageInstalled', return_value=True)
+	@mock.patch('AliceNluTrainer.main.fitEngine')
+	def test_trainingThreadStartsPendingTask(self, fitEngine, _isLanguageInstalled, _getLanguageResources):
+		fitEngine.return_value.persist.side_effect = persistEngine
+		dataset = {'language': 'de', **TRAINING_DATA}
+		self.trainer._training = True
+		self.trainer._pendingTraining = ('de', dataset)
+
+		with mock.patch.object(self.trainer, 'startTrainingThread') as startTrainingThread:
+			self.trainer.trainingThread(language='en', dataset={'language': 'en', **TRAINING_DATA})
+
+		startTrainingThread.assert_called_once_with('de', dataset)
+		self.assertTrue(self.trainer._training)
+		self.assertIsNone(self.trainer._pendingTraining)
+
+
+	@mock.patch.object(NLUTrainer, 'getLanguageResources')
+	@mock.patch.object(NLUTrainer, 'isLanguageInstalled', return_value=True)
+	@mock.patch('AliceNluTrainer.main.fitEngine')
+	def test_trainingThreadPublishesResult(self, fitEngine, _isLanguageInstalled, _getLanguageResources):
+		fitEngine.return_value.persist.side_effect = persistEngine
+		self.trainer._training = True
+
+		with mock.patch.object(self.trainer, 'startTrainingThread') as startTrainingThread:
+			self.trainer.trainingThread(language='en', dataset={'language': 'en', **TRAINING_DATA})
+
+		startTrainingThread.assert_not_called()
+		self.assertFalse(self.trainer._training)
+
+		_, kwargs = self.mqttClient.publish.call_args
+		self.assertEqual(NLUTrainer.TOPIC_TRAINING_RESULT.format(hashlib.blake2b(kwargs['payload']).hexdigest()), kwargs['topic'])
+		self.assertEqual(1, kwargs['qos'])
+		self.assertEqual(1, len(list(self.cacheDir.glob('*.zip'))))
+
+
+	def test_trainingStatusIgnoresAnswers(self):
+		self.trainer.onMqttMessage(None, None, self.message(NLUTrainer.TOPIC_TRAINING_STATUS, b'{"status": "done"}'))
+		self.mqttClient.publish.assert_not_called()
+
+
+	def test_trainingStatusAnswersRequests(self):
+		self.trainer._training = True
+		self.trainer.onMqttMessage(None, None, self.message(NLUTrainer.TOPIC_TRAINING_STATUS))
+		self.mqttClient.publish.assert_called_once_with(NLUTrainer.TOPIC_TRAINING_STATUS, payload=json.dumps({'status': 'training'}))
+
+
+	def test_zipDirectory(self):
+		with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as destination:
+			files = {
+				'nlu_engine.json'                     : b'{"model_version": "0.20.0"}',
+				'resources/en/metadata.json'          : b'{"language": "en"}',
+				'probabilistic_intent_parser/crf.bin' : os.urandom(4096)
+			}
+			for name, content in files.items():
+				path = Path(source, name)
+				path.parent.mkdir(parents=True, exist_ok=True)
+				path.write_bytes(content)
+
+			data, digest = NLUTrainer.zipDirectory(Path(source))
+			self.assertEqual(hashlib.blake2b(data).hexdigest(), digest)
+
+			archive = Path(destination, 'archive.zip')
+			archive.write_bytes(data)
+			with zipfile.ZipFile(archive) as zipped:
+				self.assertIsNone(zipped.testzip())
+				zipped.extractall(destination)
+
+			for name, content in files.items():
+				self.assertEqual(content, Path(destination, name).read_bytes())
+
+
+	def test_datasetHashIgnoresKeysOrder(self):
+		self.assertEqual(
+			NLUTrainer.datasetHash({'language': 'en', 'intents': {'a': 1, 'b': 2}, 'entities': dict()}),
+			NLUTrainer.datasetHash({'entities': dict(), 'intents': {'b': 2, 'a': 1}, 'language': 'en'})
+		)
+
+
+	def test_cacheTrainedNLUKeepsMostRecent(self):
+		old = [self.cacheDir / f'old{i}.zip' for i in range(NLUTrainer.CACHE_SIZE + 2)]
+		for i, file in enumerate(old):
+			file.write_bytes(b'zip')
+			os.utime(file, (1000 + i, 1000 + i))
+
+		orphan = self.cacheDir / 'orphan.part'
+		orphan.write_bytes(b'zip')
+
+		self.trainer.cacheTrainedNLU(datasetHash='new', data=b'zip')
+
+		expected = {file.name for file in old[-(NLUTrainer.CACHE_SIZE - 1):]} | {'new.zip'}
+		self.assertEqual(expected, {file.name for file in self.cacheDir.iterdir()})
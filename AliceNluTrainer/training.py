@@ -0,0 +1,124 @@
+#  Copyright (c) 2022
+#
+#  This file, training.py, is part of Project Alice.
+#
+#  Project Alice is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>
+#
+#  Last modified: 2022.01.17 at 14:36:59 CET
+import tempfile
+from copy import deepcopy
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from joblib import Parallel, cpu_count, delayed
+from snips_nlu import NLUEngineConfig, SnipsNLUEngine
+from snips_nlu.constants import INTENTS, LANGUAGE
+from snips_nlu.dataset import validate_and_format_dataset
+from snips_nlu.default_configs import DEFAULT_CONFIGS
+from snips_nlu.entity_parser import BuiltinEntityParser, CustomEntityParser
+from snips_nlu.intent_parser import IntentParser, ProbabilisticIntentParser
+from snips_nlu.pipeline.configs import ProcessingUnitConfig
+from snips_nlu.resources import load_resources
+from snips_nlu.slot_filler import SlotFiller
+
+
+BUILTIN_ENTITY_PARSER_DIR = 'builtinEntityParser'
+CUSTOM_ENTITY_PARSER_DIR = 'customEntityParser'
+
+
+def fitEngine(dataset: Dict, resources: dict) -> SnipsNLUEngine:
+	"""
+	Fits a snips NLU engine like 'snips-nlu train' does, except that the slot fillers of the
+	probabilistic intent parser, one crf per intent, are fitted in parallel worker processes.
+	They are then handed to the engine as a pre trained parser, which snips reuses as is
+	:param dataset: The snips dataset to train on
+	:param resources: The already loaded resources for the dataset language
+	:return: The fitted engine
+	"""
+	dataset = validate_and_format_dataset(dataset)
+	config = DEFAULT_CONFIGS.get(dataset[LANGUAGE])
+	engine = SnipsNLUEngine(config=NLUEngineConfig.from_dict(config) if config else NLUEngineConfig(), resources=resources)
+	engine.fit_builtin_entity_parser_if_needed(dataset)
+	engine.fit_custom_entity_parser_if_needed(dataset)
+
+	shared = {
+		'builtin_entity_parser': engine.builtin_entity_parser,
+		'custom_entity_parser' : engine.custom_entity_parser,
+		'resources'            : resources,
+		'random_state'         : engine.random_state
+	}
+
+	for parserConfig in engine.config.intent_parsers_configs:
+		if parserConfig.unit_name != ProbabilisticIntentParser.unit_name:
+			continue
+
+		parser = IntentParser.from_config(parserConfig, **shared)
+		parser.slot_fillers = fitSlotFillers(engine=engine, dataset=dataset, slotFillerConfig=parserConfig.slot_filler_config, shared=shared)
+		engine.intent_parsers.append(parser)
+
+	return engine.fit(dataset, force_retrain=False)
+
+
+def fitSlotFillers(engine: SnipsNLUEngine, dataset: Dict, slotFillerConfig: ProcessingUnitConfig, shared: Dict) -> Dict[str, SlotFiller]:
+	"""
+	Spreads the intents over as many worker processes as there are cpu cores. The entity parsers
+	wrap native objects that can't be pickled, so they go through the disk, same as the fitted slot fillers
+	"""
+	intents = list(dataset[INTENTS])
+	if not intents:
+		return dict()
+
+	jobs = min(cpu_count(), len(intents))
+
+	with tempfile.TemporaryDirectory() as tempDir:
+		workDir = Path(tempDir)
+		engine.builtin_entity_parser.persist(workDir / BUILTIN_ENTITY_PARSER_DIR)
+		engine.custom_entity_parser.persist(workDir / CUSTOM_ENTITY_PARSER_DIR)
+
+		indexedIntents = list(enumerate(intents))
+		batches = [indexedIntents[i::jobs] for i in range(jobs)]
+		results = Parallel(n_jobs=jobs, backend='loky')(
+			delayed(fitSlotFillerBatch)(dataset, slotFillerConfig, batch, str(workDir)) for batch in batches
+		)
+
+		return {
+			intent: SlotFiller.load_from_path(path, **shared)
+			for batch in results
+			for intent, path in batch
+		}
+
+
+def fitSlotFillerBatch(dataset: Dict, slotFillerConfig: ProcessingUnitConfig, intents: List[Tuple[int, str]], workDir: str) -> List[Tuple[str, str]]:
+	"""
+	Runs in a worker process. Fits and persists the slot filler of each given intent
+	:return: The intent names along with the path their slot filler was persisted to
+	"""
+	workDir = Path(workDir)
+	shared = {
+		'builtin_entity_parser': BuiltinEntityParser.from_path(workDir / BUILTIN_ENTITY_PARSER_DIR),
+		'custom_entity_parser' : CustomEntityParser.from_path(workDir / CUSTOM_ENTITY_PARSER_DIR),
+		'resources'            : load_resources(dataset[LANGUAGE], slotFillerConfig.get_required_resources())
+	}
+
+	fitted = list()
+	for index, intent in intents:
+		# The config can be mutated while fitting, each slot filler needs its own copy
+		slotFiller = SlotFiller.from_config(deepcopy(slotFillerConfig), **shared)
+		slotFiller.fit(dataset, intent)
+
+		path = workDir / f'slotFiller{index}'
+		slotFiller.persist(path)
+		fitted.append((intent, str(path)))
+
+	return fitted
@@ -42,11 +42,16 @@ setup(
 		'paho-mqtt~=1.6.1',
 		'toml~=0.10.2',
 		'snips-nlu==0.20.2',
+		'joblib~=1.1.0',
+		'importlib-metadata~=4.10.0; python_version < "3.8"',
 		'pytest~=6.2.5',
 		'coverage~=6.2',
 		'pytest-cov~=3.0.0',
 		'coveralls~=3.3.1'
     ],
+	extras_require={
+		'orjson': ['orjson~=3.6.5']
+	},
 	classifiers=[
 		"Development Status :: 5 - Production/Stable",
 		"Environment :: Console",